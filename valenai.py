@@ -1,25 +1,54 @@
-from fastapi import FastAPI, Request
+from fastapi import BackgroundTasks, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 import google.generativeai as genai
-import json
+import asyncio
+import datetime
+import hashlib
+import math
+import operator
+import orjson
 import os
 import re
-from collections import deque
+import time
+from array import array
+from collections import OrderedDict, deque
 from google.api_core import exceptions as google_exceptions
-import requests
-import psycopg2
-import psycopg2.extras  # For using dictionaries with cursors
-import logging  # Added for debugging
+import asyncpg
+import logging
+import logging.handlers
+import queue
+
+# --- Logging ---
+# Handlers only put records on a queue and a listener thread writes them, so requests never wait on
+# stdout. The message is still formatted where it is logged (QueueHandler.prepare), only the I/O
+# leaves the event loop. The listener runs from startup to shutdown (records logged before that are kept).
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+logger = logging.getLogger(__name__)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Allow requests from anywhere (you can restrict this later)     
-    allow_credentials=True,
-    allow_methods=["*"],
+    allow_origins=["*"],  # Allow requests from anywhere (you can restrict this later)
+    allow_credentials=False,  # No cookies or auth headers are used; credentials can't be combined with "*"
+    allow_methods=["GET", "POST"],
     allow_headers=["*"],
+    max_age=86400,  # Browsers may cache a preflight for a day instead of the default 10 minutes
 )
 
+@app.on_event("startup")
+async def start_logging():
+    """Starts writing queued log records."""
+    _log_listener.start()
+
+@app.on_event("shutdown")
+async def stop_logging():
+    """Writes the remaining log records and stops the listener thread."""
+    _log_listener.stop()
+
 # --- Gemini API Keys ---
 API_KEYS_STRING = os.getenv("GEMINI_API_KEYS")
 if not API_KEYS_STRING:
@@ -35,26 +64,77 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("Missing environment variable: DATABASE_URL")
 
-def get_next_api_key():
-    """Rotates and returns the next available API key."""
-    api_key_queue.rotate(-1)
-    return api_key_queue[0]
+# Per-worker connection pool bounds (total backends = workers * DB_POOL_MAX)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+# Set to 0 when DATABASE_URL points at PgBouncer in transaction pooling mode: prepared statements
+# don't survive being handed to another server connection there (asyncpg's default cache is 100)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
 
-def get_db_connection():
-    """Establishes a connection to the PostgreSQL database."""
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        return conn
-    except Exception as e:
-        print(f"❌ Error connecting to the database: {e}")
-        raise  # Re-raise the exception to halt execution
+# --- API Key Health ---
+# A key that hits its quota cools down for a while; a key that is rejected is disabled for good.
+KEY_COOLDOWN_SECONDS = 60
+KEY_STATE = {key: {"cooldown_until": 0.0, "disabled": False} for key in API_KEYS}
+api_key_lock = asyncio.Lock()
+
+KEYS_EXHAUSTED_REPLY = "Due to unexpected capacity constraints, I am unable to respond to your message. Please try again soon."
 
-def create_tables(conn):
+def get_next_api_key():
+    """Rotates to the next healthy API key and returns it, or None if no key is usable right now."""
+    now = time.monotonic()
+    for _ in range(len(api_key_queue)):
+        api_key_queue.rotate(-1)
+        key = api_key_queue[0]
+        if not KEY_STATE[key]["disabled"] and now >= KEY_STATE[key]["cooldown_until"]:
+            return key
+    return None
+
+def classify_key_error(e):
+    """Returns "quota" or "invalid" if a Gemini ClientError was caused by the API key, else None."""
+    message = str(e).lower()
+    if isinstance(e, google_exceptions.ResourceExhausted) or "quota" in message:
+        return "quota"
+    if isinstance(e, (google_exceptions.Unauthenticated, google_exceptions.PermissionDenied)) or "api key" in message:
+        return "invalid"
+    return None
+
+async def switch_api_key(failed_key, reason):
+    """Records the failure of failed_key and activates the next healthy key. Returns False if none is left."""
+    global CHAT_MODEL, TITLE_MODEL
+    async with api_key_lock:
+        if reason == "invalid":
+            KEY_STATE[failed_key]["disabled"] = True
+        else:
+            KEY_STATE[failed_key]["cooldown_until"] = time.monotonic() + KEY_COOLDOWN_SECONDS
+
+        if api_key_queue[0] != failed_key:
+            return True  # A concurrent request already moved on to another key
+
+        key = get_next_api_key()
+        if key is None:
+            return False
+        # google.generativeai has no per-call API key, so the key is process-wide SDK state. It only changes
+        # here, under api_key_lock. A model binds the configured client on its first call; a request that
+        # still ran on the previous key and fails reports that key, which is then no longer
+        # api_key_queue[0], so it just retries on the current one (see above).
+        genai.configure(api_key=key)
+        CHAT_MODEL = build_chat_model()
+        TITLE_MODEL = build_title_model()
+        return True
+
+# Advisory lock key held while the schema is set up (any constant works, as long as it stays the same)
+SCHEMA_LOCK_ID = 74612024
+
+async def create_tables(conn):
     """Creates the necessary tables in the database."""
     try:
-        with conn.cursor() as cursor:
+        async with conn.transaction():  # Rolls back automatically if any statement fails
+            # Every worker runs this at startup; concurrent CREATE ... IF NOT EXISTS can still collide on the
+            # catalogs, so workers take turns. The lock is released when the transaction ends.
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_ID)
+
             # Create the 'users' table
-            cursor.execute(
+            await conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS users (
                     user_id TEXT PRIMARY KEY
@@ -63,60 +143,144 @@ def create_tables(conn):
             )
 
             # Create the 'chats' table
-            cursor.execute(
+            await conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS chats (
                     chat_id TEXT PRIMARY KEY,
                     user_id TEXT NOT NULL,
                     title TEXT,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                    edited_at TIMESTAMP WITH TIME ZONE,
                     FOREIGN KEY (user_id) REFERENCES users(user_id)
                 );
                 """
             )
 
+            # Message roles are stored as a 4-byte enum instead of TEXT (asyncpg still reads and writes them as str)
+            await conn.execute(
+                """
+                DO $$ BEGIN
+                    CREATE TYPE msg_role AS ENUM ('user', 'bot');
+                EXCEPTION WHEN duplicate_object OR unique_violation THEN NULL;
+                END $$;
+                """
+            )
+
             # Create the 'messages' table
-            cursor.execute(
+            await conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS messages (
                     message_id SERIAL PRIMARY KEY,
                     chat_id TEXT NOT NULL,
                     user_id TEXT NOT NULL,
-                    role TEXT NOT NULL,
+                    role msg_role NOT NULL,
                     content TEXT NOT NULL,
                     timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+                    FOREIGN KEY (chat_id) REFERENCES chats(chat_id) ON DELETE CASCADE
                 );
                 """
             )
 
+            # Migrate tables created before the enum existed (one-off rewrite; a no-op afterwards)
+            await conn.execute(
+                """
+                DO $$ BEGIN
+                    IF (SELECT data_type FROM information_schema.columns
+                        WHERE table_name = 'messages' AND column_name = 'role') = 'text' THEN
+                        ALTER TABLE messages ALTER COLUMN role TYPE msg_role USING role::msg_role;
+                    END IF;
+                END $$;
+                """
+            )
+
+            # Index for history loads (WHERE chat_id = ... ORDER BY timestamp). INCLUDE (message_id) keeps
+            # lookups of a chat's newest message id index-only. 'content' is deliberately not INCLUDEd:
+            # long replies would exceed the btree row size limit.
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_chat_ts ON messages (chat_id, timestamp) INCLUDE (message_id);"
+            )
+
+            # Chats created before created_at existed all get the migration time (and sort by chat_id among themselves)
+            await conn.execute(
+                "ALTER TABLE chats ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP;"
+            )
+
+            # When a message of the chat was last edited in place (cached histories are validated against it)
+            await conn.execute("ALTER TABLE chats ADD COLUMN IF NOT EXISTS edited_at TIMESTAMP WITH TIME ZONE;")
+
+            # Index for listing a user's chats newest first (no sort needed). It also serves every other
+            # lookup by user_id. 'title' is not INCLUDEd:
+            # /update_title accepts any length, which could exceed the btree row size limit.
+            await conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_chats_user_created ON chats (user_id, created_at DESC, chat_id DESC);"
+            )
+
             # Create the 'favorites' table (since you have /add_favorite and /remove_favorite endpoints)
-            cursor.execute(
+            await conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS favorites (
                     user_id TEXT NOT NULL,
                     chat_id TEXT NOT NULL,
                     PRIMARY KEY (user_id, chat_id),
                     FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+                    FOREIGN KEY (chat_id) REFERENCES chats(chat_id) ON DELETE CASCADE
                 );
                 """
             )
 
-        conn.commit()
-        print("✅ Tables created successfully.")
+            # Give tables created before the cascades existed the ON DELETE CASCADE foreign keys (a no-op afterwards)
+            await conn.execute(
+                """
+                DO $$ BEGIN
+                    IF EXISTS (SELECT 1 FROM pg_constraint
+                               WHERE conname = 'messages_chat_id_fkey' AND confdeltype <> 'c') THEN
+                        ALTER TABLE messages
+                            DROP CONSTRAINT messages_chat_id_fkey,
+                            ADD CONSTRAINT messages_chat_id_fkey
+                                FOREIGN KEY (chat_id) REFERENCES chats(chat_id) ON DELETE CASCADE;
+                    END IF;
+                    IF EXISTS (SELECT 1 FROM pg_constraint
+                               WHERE conname = 'favorites_chat_id_fkey' AND confdeltype <> 'c') THEN
+                        ALTER TABLE favorites
+                            DROP CONSTRAINT favorites_chat_id_fkey,
+                            ADD CONSTRAINT favorites_chat_id_fkey
+                                FOREIGN KEY (chat_id) REFERENCES chats(chat_id) ON DELETE CASCADE;
+                    END IF;
+                END $$;
+                """
+            )
+
+            # The primary key only serves lookups by user_id; deleting a chat checks favorites by chat_id
+            await conn.execute("CREATE INDEX IF NOT EXISTS idx_favorites_chat ON favorites (chat_id);")
+
+        logger.info("✅ Tables created successfully.")
+
+        # Refresh planner statistics so the new indexes are picked up right away
+        await conn.execute("ANALYZE messages;")
 
     except Exception as e:
-        print(f"❌ Error creating tables: {e}")
-        conn.rollback()  # Rollback changes if an error occurs
+        logger.error(f"❌ Error creating tables: {e}")
         raise
 
-# --- Database Connection and Table Creation --- 
-try:
-    conn = get_db_connection()  # Establish the connection
-    create_tables(conn)  # Create tables (if they don't exist)
-except Exception as e:
-    print(f"❌ Application startup failed: {e}")
-    exit(1) # Exit the application if database setup fails
+# --- Database Pool and Table Creation (once per worker, at startup) ---
+@app.on_event("startup")
+async def init_db():
+    """Creates this worker's connection pool and runs the idempotent table setup."""
+    try:
+        app.state.pool = await asyncpg.create_pool(
+            DATABASE_URL, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, command_timeout=30,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE
+        )
+    except Exception as e:
+        logger.error(f"❌ Application startup failed: {e}")
+        raise  # Abort startup if the database is unreachable
+    async with app.state.pool.acquire() as conn:
+        await create_tables(conn)  # Create tables (if they don't exist)
+
+@app.on_event("shutdown")
+async def close_db():
+    """Closes this worker's connection pool."""
+    await app.state.pool.close()
 
 genai.configure(api_key=api_key_queue[0])  # Initial API key
 # --- Personality Prompt ---
@@ -224,20 +388,143 @@ Contextual Understanding and Follow-Up Questions:
 
 """
 
+CHAT_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+}
+
+def build_chat_model():
+    """Builds the chat model.
+
+    PERSONALITY_PROMPT is always the system instruction and never changes between requests, so
+    every request starts with the same prefix, which Gemini's implicit caching matches and discounts.
+    (It is below gemini-2.5-pro's minimum size for an explicit context cache.) Anything per-request
+    (user details, dates, history) belongs in the chat turns, never in it.
+    """
+    return genai.GenerativeModel(
+        "gemini-2.5-pro",
+        system_instruction=PERSONALITY_PROMPT,
+        generation_config=CHAT_GENERATION_CONFIG,
+    )
+
+# Titles should be predictable rather than creative (they are also cached by message). No
+# max_output_tokens cap: gemini-2.5-pro always thinks first, and thinking tokens count against it.
+TITLE_GENERATION_CONFIG = {
+    "temperature": 0.3,
+}
+
+def build_title_model():
+    """Builds the model used for chat titles."""
+    return genai.GenerativeModel("gemini-2.5-pro", generation_config=TITLE_GENERATION_CONFIG)
+
+# Built once and reused across requests; rebuilt after an API key switch so they use the new key
+CHAT_MODEL = build_chat_model()
+TITLE_MODEL = build_title_model()
+
+# CONTEXT WINDOW LIMIT: how many of the most recent messages are sent back to the model
+CONTEXT_WINDOW = 100
+
+# Newest CONTEXT_WINDOW messages of a chat, oldest first (walks idx_messages_chat_ts backwards)
+RECENT_HISTORY_SQL = f"""
+    SELECT role, content FROM (
+        SELECT role, content, timestamp FROM messages WHERE chat_id = $1 ORDER BY timestamp DESC LIMIT {CONTEXT_WINDOW}
+    ) recent ORDER BY timestamp ASC
+"""
 
+# CONTEXT BUDGET: roughly how much history text (in characters, ~4 per token) is sent back to the model.
+# The row window above only bounds the query; this keeps long messages from blowing up the prompt.
+CONTEXT_CHAR_BUDGET = 24000
+
+def trim_history(rows):
+    """Keeps the newest (role, content) rows that fit in CONTEXT_CHAR_BUDGET, oldest first."""
+    kept = []
+    used = 0
+    for role, content in reversed(rows):
+        used += len(content)
+        if used > CONTEXT_CHAR_BUDGET:
+            break
+        kept.append((role, content))
+    kept.reverse()
+    # Don't open the history with a dangling bot reply whose question was cut off
+    if kept and kept[0][0] != "user":
+        kept.pop(0)
+    return kept
+
+# The chat row (whoever owns it) plus the id of its newest message; together with edited_at it tells
+# whether a cached history is still current
+CHAT_STATE_SQL = """
+    SELECT user_id, title, edited_at,
+           (SELECT message_id FROM messages WHERE chat_id = $1 ORDER BY timestamp DESC LIMIT 1) AS last_message_id
+    FROM chats WHERE chat_id = $1
+"""
 
-def generate_title(first_message: str) -> str:
-    """Generates a concise but meaningful title for the chat based on the first message."""
-    try:
-        # 1. Truncate very long messages for the title generation prompt
-        truncated_message = first_message[:200] + "..." if len(first_message) > 200 else first_message
-
-        model = genai.GenerativeModel("gemini-2.5-pro")  # Keep the model as specified
-
-        # 2. Improved prompt for better title generation
-        prompt = f"""
-Generate a short, descriptive title for a chat conversation based on this user message:
-"{truncated_message}"
+# Per-worker LRU of recent history: chat_id -> ((newest message_id, edited_at), deque of (role, content),
+# characters held). A hit skips the RECENT_HISTORY_SQL read. Entries are validated against the database
+# on every use: turns written by other workers change the newest message_id and edits bump
+# chats.edited_at. This worker only extends an entry with turns it stored right after the cached newest
+# message.
+# Bounded by chats and by the message text held in total: one entry can hold up to CONTEXT_WINDOW full
+# messages, so the count alone doesn't bound memory. 32M characters is about 32 MB of ASCII text per
+# worker (up to 4x that for non-Latin scripts), which keeps a few thousand typical chats cached.
+HISTORY_CACHE_SIZE = 10000
+HISTORY_CACHE_CHARS = 32_000_000
+_history_cache = OrderedDict()
+_history_cache_chars = 0
+
+def _remember_history(chat_id, state, history):
+    """Stores a chat's recent history (a deque bounded to CONTEXT_WINDOW) in the LRU under its
+    (newest message_id, edited_at) state, evicting the least recently used chats while over a bound."""
+    global _history_cache_chars
+    forget_history(chat_id)
+    chars = sum(len(content) for _, content in history)
+    _history_cache[chat_id] = (state, history, chars)
+    _history_cache_chars += chars
+    while len(_history_cache) > HISTORY_CACHE_SIZE or _history_cache_chars > HISTORY_CACHE_CHARS:
+        _, (_, _, evicted_chars) = _history_cache.popitem(last=False)
+        _history_cache_chars -= evicted_chars
+
+def forget_history(chat_id):
+    """Drops a chat's cached history after its stored messages were changed or deleted."""
+    global _history_cache_chars
+    cached = _history_cache.pop(chat_id, None)
+    if cached is not None:
+        _history_cache_chars -= cached[2]
+
+async def load_chat_state(conn, chat_id, user_id):
+    """Returns (chat row or None, recent history oldest first), reading the history from the cache when current.
+
+    A chat that belongs to another user is returned without its history; callers must reject it
+    (check chat["user_id"]) instead of treating it as a new chat.
+    """
+    chat = await conn.fetchrow(CHAT_STATE_SQL, chat_id)
+    if chat is None or chat["user_id"] != user_id:
+        return chat, []
+    state = (chat["last_message_id"], chat["edited_at"])
+    cached = _history_cache.get(chat_id)
+    if cached is not None and cached[0] == state:
+        _history_cache.move_to_end(chat_id)
+        return chat, list(cached[1])  # Snapshot: the cached deque keeps growing with later turns
+    rows = await conn.fetch(RECENT_HISTORY_SQL, chat_id)
+    history = deque(((row["role"], row["content"]) for row in rows), maxlen=CONTEXT_WINDOW)
+    _remember_history(chat_id, state, history)
+    return chat, list(history)
+
+def to_gemini_history(rows):
+    """Converts (role, content) message rows into Gemini chat history."""
+    return [{"role": "user" if role == "user" else "model", "parts": [content]} for role, content in rows]
+
+# Messages that are nothing but a greeting get a canned title without a Gemini call
+_GREETING_RE = re.compile(r'^\s*(hi+|hey+|hello+|yo+|sup|howdy|greetings)[\s!.?]*$', re.I)
+
+# Anything that isn't a word character, whitespace or a hyphen (this includes quotes)
+_TITLE_SPECIAL_CHARS_RE = re.compile(r'[^\w\s-]')
+
+# Fixed part of the title prompt. It must stay free of per-request data so that it forms an
+# identical prefix across requests (Gemini's implicit caching only matches on shared prefixes).
+TITLE_PROMPT_PREFIX = """
+Generate a short, descriptive title for a chat conversation based on the user message at the end.
 
 Requirements:
 - Must be between 6-60 characters long
@@ -254,46 +541,411 @@ Requirements:
 - Do not include quotation marks or special characters
 
 Just return the title text with no additional explanations or prefixes.
+
 """
 
-        response = model.generate_content(prompt)
+# Per-worker LRU of generated titles, keyed on the normalized truncated message, so repeated
+# first messages (pasted templates, common questions) don't cost a Gemini call
+TITLE_CACHE_SIZE = 1024
+_title_cache = OrderedDict()
+
+def _title_cache_key(truncated_message: str) -> str:
+    """Lowercases, drops punctuation and collapses whitespace so near-identical messages share a title."""
+    return " ".join(_TITLE_SPECIAL_CHARS_RE.sub('', truncated_message).lower().split())
+
+# Messages with at most this many words are title-cased into the title directly
+SHORT_TITLE_MAX_WORDS = 4
+
+async def generate_title(first_message: str) -> str:
+    """Generates a concise but meaningful title for the chat based on the first message."""
+    if _GREETING_RE.match(first_message):
+        return "Friendly Greeting"
+
+    # Very short messages already are their own best title; no need for a Gemini round trip
+    short_words = _TITLE_SPECIAL_CHARS_RE.sub('', first_message).split()
+    if 0 < len(short_words) <= SHORT_TITLE_MAX_WORDS:
+        return " ".join(word[:1].upper() + word[1:] for word in short_words)[:60]
+
+    # 1. Truncate very long messages for the title generation prompt
+    truncated_message = first_message[:200] + "..." if len(first_message) > 200 else first_message
+
+    cache_key = _title_cache_key(truncated_message)
+    if cache_key in _title_cache:
+        _title_cache.move_to_end(cache_key)
+        return _title_cache[cache_key]
+
+    try:
+        # 2. Improved prompt for better title generation
+        # Static instructions first and the message last, so every title request shares the same prefix
+        prompt = f'{TITLE_PROMPT_PREFIX}User message:\n"{truncated_message}"\n'
+
+        # Async call so the event loop keeps serving other requests while the title is generated
+        response = await TITLE_MODEL.generate_content_async(prompt)
         title = response.text.strip()
 
-        # 3. Basic sanitization
-        title = re.sub(r'[^\w\s-]', '', title)  # Remove special characters
-        title = re.sub(r'"', '', title)  # Remove any remaining quotes
+        # 3. Basic sanitization: remove special characters and quotes, collapse whitespace
+        title = " ".join(_TITLE_SPECIAL_CHARS_RE.sub('', title).split())
 
         # 4. Ensure title is not empty or too short
         if not title or len(title) < 6:
             # Try to extract a meaningful title from the message itself
             words = first_message.split()
-            if len(words) >= 3:
-                title = " ".join(words[:3])
-            else:
-                title = first_message if first_message else "New Chat"
+            title = " ".join(words[:3]) or "New Chat"
 
-        # 5. Ensure title doesn't exceed 15 characters but try to keep complete words
+        # 5. Ensure title doesn't exceed 60 characters but try to keep complete words: cut at the last
+        # space within the first 61 characters (a space at index 60 means the first 60 end on a word)
         if len(title) > 60:
-            words = title.split()
-            title = ""
-            for word in words:
-                if len(title + " " + word if title else word) <= 15:
-                    title += " " + word if title else word
-                else:
-                    break
+            cut = title.rfind(" ", 0, 61)
+            title = title[:cut] if cut > 0 else title[:60]  # A single overlong word gets cut instead of dropped
 
+        _title_cache[cache_key] = title
+        if len(_title_cache) > TITLE_CACHE_SIZE:
+            _title_cache.popitem(last=False)  # Evict the least recently used title
         return title
     except Exception as e:
-        print(f"Error generating title: {e}")
+        logger.error(f"Error generating title: {e}")
         # Fallback: use the first few words of the message
         words = first_message.split()[:3]
         fallback_title = " ".join(words)
         return fallback_title[:60] if fallback_title else "New Chat"
 
+# A "Valen:" speaker tag the model sometimes puts in front of its reply
+_SPEAKER_TAG_RE = re.compile(r'^\s*Valen:\s*')
+
+def clean_reply(text):
+    """Turns raw model output into the reply that is shown and stored."""
+    if not text or text.isspace():
+        return "I'm sorry, I couldn't generate a response. Please try again."
+    return _SPEAKER_TAG_RE.sub("", text, count=1).strip()
+
+# Per-worker exact-match reply cache: the same (trimmed) history and message get the same reply for a
+# while, e.g. greetings opening a new chat or a message sent twice. The personality prompt is the same
+# for every request, so it doesn't need to be part of the key.
+REPLY_CACHE_TTL_SECONDS = 60 * 60
+REPLY_CACHE_SIZE = 1024
+_reply_cache = OrderedDict()  # sha256 of the request -> (expires_at, reply)
+
+def _reply_cache_key(history, user_message, max_output_tokens):
+    """Hashes everything that is sent to Gemini for a reply."""
+    return hashlib.sha256(orjson.dumps([history, user_message, max_output_tokens])).hexdigest()
+
+# Per-worker semantic cache for opening messages: a message with no history before it that means the same
+# as one the user already opened a chat with ("hey there" / "hi there!") gets that reply without a Gemini
+# call. Later turns depend on the conversation, so they only use the exact-match cache above. Entries are
+# kept per user, because an opening message may carry personal details that the reply repeats.
+# The threshold is deliberately strict (a wrong reply costs more than a missed hit): it is meant to let
+# only near-paraphrases match, such as greetings that differ in punctuation or filler words.
+# Embeddings are kept as float32 arrays (768 floats, ~3 KB each), so 256 users x 16 entries hold about
+# 13 MB of embeddings per worker, plus the replies (at most max_output_tokens each). A lookup compares
+# against at most 16 entries on the event loop, well under a millisecond.
+EMBEDDING_MODEL = "models/text-embedding-004"
+SEMANTIC_CACHE_MIN_SIMILARITY = 0.95
+SEMANTIC_CACHE_PER_USER = 16
+SEMANTIC_CACHE_USERS = 256
+_semantic_cache = OrderedDict()  # (user_id, max_output_tokens) -> deque of (expires_at, unit embedding, reply)
+
+async def _embed(text):
+    """Returns the embedding of text scaled to unit length, so a dot product is the cosine similarity."""
+    result = await genai.embed_content_async(
+        model=EMBEDDING_MODEL, content=text, task_type="semantic_similarity"
+    )
+    vector = result["embedding"]
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return array("f", (x / norm for x in vector))
+
+def _semantic_lookup(namespace, embedding):
+    """Returns the unexpired cached reply most similar to embedding, if any is similar enough."""
+    entries = _semantic_cache.get(namespace)
+    if not entries:
+        return None
+    _semantic_cache.move_to_end(namespace)
+    now = time.monotonic()
+    best_reply, best_similarity = None, SEMANTIC_CACHE_MIN_SIMILARITY
+    for expires_at, cached_embedding, reply in entries:
+        if expires_at > now:
+            similarity = sum(map(operator.mul, embedding, cached_embedding))
+            if similarity >= best_similarity:
+                best_reply, best_similarity = reply, similarity
+    return best_reply
+
+def _semantic_store(namespace, embedding, reply):
+    """Remembers reply for embedding (each user keeps their SEMANTIC_CACHE_PER_USER most recent)."""
+    entries = _semantic_cache.get(namespace)
+    if entries is None:
+        entries = _semantic_cache[namespace] = deque(maxlen=SEMANTIC_CACHE_PER_USER)
+    _semantic_cache.move_to_end(namespace)
+    entries.append((time.monotonic() + REPLY_CACHE_TTL_SECONDS, embedding, reply))
+    if len(_semantic_cache) > SEMANTIC_CACHE_USERS:
+        _semantic_cache.popitem(last=False)  # Forget the least recently active user
+
+# Identical requests that arrive while one is already being generated share its Gemini call
+_inflight_replies = {}  # cache key -> [task running _ask_gemini, number of callers waiting for it]
+
+def _forget_inflight(cache_key, inflight):
+    """Removes inflight from _inflight_replies unless a newer call has replaced it."""
+    if _inflight_replies.get(cache_key) is inflight:
+        del _inflight_replies[cache_key]
+
+async def _ask_gemini(history, user_message, max_output_tokens):
+    """Makes one Gemini call for a reply. Returns (reply, cacheable)."""
+    # The personality prompt lives in the model's system instruction, so only the turns are sent here
+    chat_session = CHAT_MODEL.start_chat(history=to_gemini_history(history))
+    generation_config = {"max_output_tokens": max_output_tokens} if max_output_tokens else None
+    response = await chat_session.send_message_async(user_message, generation_config=generation_config)
+    bot_reply = clean_reply(response.text)
+    logger.info(f"Bot reply: {bot_reply}")
+    usage = response.usage_metadata
+    # Cached tokens are Gemini's implicit prefix cache hits (the system instruction and earlier turns)
+    logger.info(f"Prompt tokens: {usage.prompt_token_count} (cached: {usage.cached_content_token_count})")
+    return bot_reply, bool(response.text and not response.text.isspace())  # Never cache the fallback reply
+
+async def _generate_reply(history, user_message, max_output_tokens=None, use_cache=True, user_id=None):
+    """Generates the bot reply to user_message given the history. Returns the reply.
+
+    Every endpoint that talks to Gemini goes through here, so they share one generation path.
+    history is expected to be windowed already (see RECENT_HISTORY_SQL) and is trimmed to
+    CONTEXT_CHAR_BUDGET here. use_cache=False always makes its own Gemini call (and doesn't cache the result).
+    Opening messages (no history) of a known user_id also go through the semantic cache.
+    """
+    # Decided on the full history: trimming may leave a long last turn with no history before it
+    semantic = use_cache and not history and user_id not in (None, "unknown_user")
+    history = trim_history(history)
+    if not use_cache:
+        bot_reply, _ = await _ask_gemini(history, user_message, max_output_tokens)
+        return bot_reply
+
+    cache_key = _reply_cache_key(history, user_message, max_output_tokens)
+    cached = _reply_cache.get(cache_key)
+    if cached is not None and cached[0] > time.monotonic():
+        _reply_cache.move_to_end(cache_key)
+        logger.info(f"Bot reply (cached): {cached[1]}")
+        return cached[1]
+
+    inflight = _inflight_replies.get(cache_key)
+    if inflight is None:
+        inflight = [asyncio.create_task(_ask_gemini(history, user_message, max_output_tokens)), 0]
+        _inflight_replies[cache_key] = inflight
+        inflight[0].add_done_callback(lambda _: _forget_inflight(cache_key, inflight))
+    task = inflight[0]
+    inflight[1] += 1
+    try:
+        # The message is embedded while Gemini is already working, so a semantic cache miss adds no latency
+        embedding = None
+        semantic_namespace = (user_id, max_output_tokens)
+        if semantic:
+            try:
+                embedding = await _embed(user_message)
+            except Exception as e:
+                # Only the cache is lost; a key problem also fails (and rotates) the Gemini call
+                logger.error(f"Error embedding message: {e}")
+            if embedding is not None:
+                semantic_reply = _semantic_lookup(semantic_namespace, embedding)
+                if semantic_reply is not None:
+                    logger.info(f"Bot reply (semantic cache): {semantic_reply}")
+                    return semantic_reply
+        # shield: one caller going away (e.g. a client disconnect) must not cancel the call for the others
+        bot_reply, cacheable = await asyncio.shield(task)
+    finally:
+        inflight[1] -= 1
+        if inflight[1] == 0 and not task.done():
+            # Nobody is waiting for the reply any more (semantic hit or disconnect): stop paying for it
+            _forget_inflight(cache_key, inflight)
+            task.cancel()
+
+    if cacheable:
+        _reply_cache[cache_key] = (time.monotonic() + REPLY_CACHE_TTL_SECONDS, bot_reply)
+        _reply_cache.move_to_end(cache_key)
+        if len(_reply_cache) > REPLY_CACHE_SIZE:
+            _reply_cache.popitem(last=False)  # Evict the least recently used reply
+        if embedding is not None:
+            _semantic_store(semantic_namespace, embedding, bot_reply)
+    return bot_reply
+
+# The chat's newest message before the statement ran (the statement's own rows aren't visible to it)
+PREVIOUS_MESSAGE_ID_SQL = "(SELECT message_id FROM messages WHERE chat_id = $1 ORDER BY timestamp DESC LIMIT 1)"
+
+# Both turns in one statement; the bot's reply is stamped 1 millisecond later so it sorts after the message
+INSERT_TURNS_SQL = f"""
+    INSERT INTO messages (chat_id, user_id, role, content, timestamp)
+    VALUES ($1, $2, 'user', $3, CURRENT_TIMESTAMP),
+           ($1, $2, 'bot', $4, CURRENT_TIMESTAMP + INTERVAL '1 millisecond')
+    RETURNING message_id, role, {PREVIOUS_MESSAGE_ID_SQL} AS previous_message_id
+"""
+
+# Same, but also creates the user (if they don't exist) and the chat. ON CONFLICT on the chat: a quick
+# follow-up message may have seen the chat as new too. The messages are only inserted if the chat is
+# this user's (just created, or already theirs), never into a chat another user created meanwhile;
+# then nothing is returned. The foreign keys are checked at the end of the statement, so the messages
+# may reference the chat inserted by the CTE.
+INSERT_NEW_CHAT_TURNS_SQL = f"""
+    WITH new_user AS (
+        INSERT INTO users (user_id) VALUES ($2) ON CONFLICT (user_id) DO NOTHING
+    ), new_chat AS (
+        INSERT INTO chats (chat_id, user_id, title) VALUES ($1, $2, $5) ON CONFLICT (chat_id) DO NOTHING
+        RETURNING chat_id
+    )
+    INSERT INTO messages (chat_id, user_id, role, content, timestamp)
+    SELECT $1, $2, turn.role, turn.content, turn.timestamp
+    FROM (VALUES ('user'::msg_role, $3, CURRENT_TIMESTAMP),
+                 ('bot'::msg_role, $4, CURRENT_TIMESTAMP + INTERVAL '1 millisecond')) AS turn (role, content, timestamp)
+    WHERE EXISTS (SELECT 1 FROM new_chat)
+       OR EXISTS (SELECT 1 FROM chats WHERE chat_id = $1 AND user_id = $2)
+    RETURNING message_id, role, {PREVIOUS_MESSAGE_ID_SQL} AS previous_message_id
+"""
+
+async def _store_turns(chat_id, user_id, user_message, bot_reply, new_chat_title=None):
+    """Stores the user message and the bot reply in a single statement (one round trip, atomic).
+    If new_chat_title is given, the user and chat rows are created by the same statement."""
+    async with app.state.pool.acquire() as conn:
+        if new_chat_title is None:
+            inserted = await conn.fetch(INSERT_TURNS_SQL, chat_id, user_id, user_message, bot_reply)
+        else:
+            inserted = await conn.fetch(
+                INSERT_NEW_CHAT_TURNS_SQL, chat_id, user_id, user_message, bot_reply, new_chat_title
+            )
+        if not inserted:
+            logger.warning(f"Messages not stored: chat {chat_id} belongs to another user")
+            return
+        logger.info(f"Inserted messages: {[(row['role'], row['message_id']) for row in inserted]}")
+
+    # Extend the cached history with the new turns so the next message doesn't have to reload it
+    # (the deque drops the oldest turns by itself once it holds CONTEXT_WINDOW of them). If another
+    # worker stored turns since the entry was cached, it is missing those and is dropped instead.
+    cached = _history_cache.get(chat_id)
+    if cached is not None:
+        (last_message_id, edited_at), history, _ = cached
+        if inserted[0]["previous_message_id"] != last_message_id:
+            forget_history(chat_id)
+            return
+        bot_message_id = next(row["message_id"] for row in inserted if row["role"] == "bot")
+        history.extend((("user", user_message), ("bot", bot_reply)))
+        _remember_history(chat_id, (bot_message_id, edited_at), history)
+
+async def _persist_turns(chat_id, user_id, user_message, bot_reply, new_chat_title=None):
+    """Background task version of _store_turns, run after the reply has been sent to the client.
+
+    Failures can no longer reach the client, so they are only logged.
+    """
+    try:
+        await _store_turns(chat_id, user_id, user_message, bot_reply, new_chat_title=new_chat_title)
+    except Exception as e:
+        logger.error(f"Failed to store messages for chat {chat_id}: {e}")
+
+# Chat turns being answered in this worker: (chat_id, user_id, message) -> task producing the response.
+# A duplicate submit (double click, client retry) while the first is in flight gets the same response,
+# and its turns are generated and stored only once.
+_inflight_turns = {}
+
+async def _answer_turn_once(turn_key, answer):
+    """Awaits answer() for a chat turn, or the already running answer to the same turn."""
+    task = _inflight_turns.get(turn_key)
+    if task is None:
+        task = asyncio.create_task(answer())
+        _inflight_turns[turn_key] = task
+        task.add_done_callback(
+            lambda _: _inflight_turns.pop(turn_key) if _inflight_turns.get(turn_key) is task else None
+        )
+    # shield: the duplicate's client going away must not cancel the first request's answer
+    return await asyncio.shield(task)
+
+async def _start_reply_stream(history, user_message):
+    """Like _generate_reply, but returns the streaming response as soon as Gemini accepts the request."""
+    chat_session = CHAT_MODEL.start_chat(history=to_gemini_history(trim_history(history)))
+    return await chat_session.send_message_async(user_message, stream=True)
+
+async def _with_key_rotation(call):
+    """Awaits call(), moving to the next API key and retrying on key-related errors.
+
+    Only the Gemini call is retried; the history is loaded once by the caller and nothing is
+    stored until a reply exists. Returns None when every key is used up. Other ClientErrors are re-raised.
+    """
+    for _ in range(len(API_KEYS)):
+        active_key = api_key_queue[0]
+        try:
+            return await call()
+        except google_exceptions.ClientError as e:
+            logger.error(f"Gemini API ClientError: {e}")
+            reason = classify_key_error(e)
+            if reason is None:
+                raise
+            logger.warning(f"Switching to the next API key ({reason})...")
+            if not await switch_api_key(active_key, reason):
+                break
+    return None
+
+async def _generate_with_key_rotation(
+    history, user_message, max_output_tokens=None, use_cache=True, user_id=None
+):
+    """_generate_reply with API key rotation (see _with_key_rotation)."""
+    return await _with_key_rotation(
+        lambda: _generate_reply(
+            history, user_message, max_output_tokens=max_output_tokens, use_cache=use_cache, user_id=user_id
+        )
+    )
+
+def _sse_event(payload):
+    """Encodes one server-sent event."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+async def _reply_event_stream(history, user_message, reply):
+    """Streams the reply as server-sent events.
+
+    Sends {"delta": text} per chunk and finishes with {"done": true, "response": reply}, where reply is
+    the cleaned full text the client should keep. A complete reply is also appended to the reply list
+    (before "done" is sent) for the response's background task to store.
+    """
+    try:
+        response = await _with_key_rotation(lambda: _start_reply_stream(history, user_message))
+        if response is None:
+            yield _sse_event({"done": True, "response": KEYS_EXHAUSTED_REPLY})
+            return
+        parts = []
+        async for chunk in response:
+            if chunk.parts:  # The final chunk may only carry the finish reason
+                parts.append(chunk.text)
+                yield _sse_event({"delta": chunk.text})
+    except Exception as e:
+        logger.error(f"Error streaming response: {e}")
+        yield _sse_event({"done": True, "response": "An error occurred while generating a response."})
+        return
+
+    bot_reply = clean_reply("".join(parts))
+    logger.info(f"Bot reply: {bot_reply}")
+    reply.append(bot_reply)
+    yield _sse_event({"done": True, "response": bot_reply})
+
+async def _persist_streamed_turns(chat_id, user_id, user_message, reply, title_task):
+    """Stores the turns of a streamed reply once the response has finished (nothing if it didn't complete)."""
+    if not reply:
+        if title_task is not None:
+            title_task.cancel()
+        return
+    new_title = await title_task if title_task is not None else None
+    await _persist_turns(chat_id, user_id, user_message, reply[0], new_chat_title=new_title)
+
+def _reply_stream_response(chat_id, user_id, history, user_message, new_chat=False):
+    """Returns the streaming response for a chat turn; both turns are stored after it has been sent.
+
+    Storing runs as the response's background task, so a client that disconnects after "done" can't
+    cancel it. A new chat's title is generated while the reply streams.
+    """
+    title_task = asyncio.create_task(generate_title(user_message)) if new_chat else None
+    reply = []
+    return StreamingResponse(
+        _reply_event_stream(history, user_message, reply),
+        media_type="text/event-stream",
+        background=BackgroundTask(_persist_streamed_turns, chat_id, user_id, user_message, reply, title_task)
+    )
+
+# --- Liveness check for the platform / load balancer (no database or Gemini work) ---
+@app.api_route("/health", methods=["GET", "HEAD"])
+async def health():
+    return {"status": "ok"}
+
 # --- New API route to create chat ---
 @app.post("/create_chat")
-async def create_chat(request: Request):
-    data = await request.json()
+async def create_chat(request: Request, background: BackgroundTasks):
+    data = orjson.loads(await request.body())
     user_id = data.get("user_id", "unknown_user")
     chat_id = data.get("chat_id")  # Must be provided by the frontend
     first_message = data.get("message")
@@ -301,191 +953,99 @@ async def create_chat(request: Request):
     if not chat_id or not first_message:
         return {"error": "Missing chat_id or message"}
 
-    # Generate the title *before* saving any history
-    title = generate_title(first_message)
-
     # Respond with the title *and* the initial bot reply
     try:
-        model = genai.GenerativeModel(
-            "gemini-2.5-pro",
-            generation_config={
-                "temperature": 0.7,
-                "top_p": 0.9,
-                "top_k": 40,
-                "max_output_tokens": 1024,
-            }
+        # A chat_id that another user already has can't be (re)created
+        async with app.state.pool.acquire() as conn:
+            owner = await conn.fetchval("SELECT user_id FROM chats WHERE chat_id = $1", chat_id)
+        if owner is not None and owner != user_id:
+            logger.warning(f"Chat {chat_id} belongs to another user")
+            return {"error": "Chat already exists"}
+
+        # Generate the title and the reply concurrently (generate_title handles its own errors),
+        # then store the user, chat and both messages in one transaction after responding
+        title, bot_reply = await asyncio.gather(
+            generate_title(first_message),
+            _generate_with_key_rotation([], first_message, max_output_tokens=1024, user_id=user_id)
         )
-        prompt = f"{PERSONALITY_PROMPT}\n\nUser: {first_message}\nAI:" # Initial Prompt
-        response = model.generate_content(prompt)
-        bot_reply = response.text.strip() if response.text else "I'm sorry, I couldn't generate a response. Please try again."
-        bot_reply = bot_reply.replace("Valen:", "").strip()
-
-        # --- Database Operations ---
-        conn = get_db_connection()  # Get a database connection
-        with conn.cursor() as cursor:
-            # 1. Insert the user (if they don't exist)
-            cursor.execute("INSERT INTO users (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING", (user_id,))
-
-            # 2. Insert the chat
-            cursor.execute("INSERT INTO chats (chat_id, user_id, title) VALUES (%s, %s, %s)", (chat_id, user_id, title))
-
-            # 3. Insert the user's message and get its timestamp
-            cursor.execute(
-                "INSERT INTO messages (chat_id, user_id, role, content) VALUES (%s, %s, %s, %s) RETURNING message_id, timestamp",
-                (chat_id, user_id, "user", first_message)
-            )
-            user_message_id, user_timestamp = cursor.fetchone()
-            print(f"Inserted user message with message_id={user_message_id}, timestamp={user_timestamp}")
-
-            # 4. Insert the bot's reply with a timestamp 1 millisecond later
-            cursor.execute(
-                "INSERT INTO messages (chat_id, user_id, role, content, timestamp) VALUES (%s, %s, %s, %s, %s + INTERVAL '1 millisecond') RETURNING message_id",
-                (chat_id, user_id, "bot", bot_reply, user_timestamp)
-            )
-            bot_message_id = cursor.fetchone()[0]
-            print(f"Inserted bot message with message_id={bot_message_id}")
-
-        conn.commit()  # Commit the changes
-        conn.close()
+        if bot_reply is None:
+            return {"title": "New Chat", "response": KEYS_EXHAUSTED_REPLY}
+        background.add_task(_persist_turns, chat_id, user_id, first_message, bot_reply, new_chat_title=title)
 
         return {"title": title, "response": bot_reply}  # Return title and AI reply
 
     except Exception as e:
-        print("Error on create_chat", e)
+        logger.error(f"Error on create_chat: {e}")
         return {"title": "New Chat", "response": "I'm sorry, I couldn't process your request. Please try again."}
 
+async def _answer_chat_turn(chat_id, user_id, message, stream, background):
+    """Shared body of /send_message and /chat: answers message in the chat and stores both turns.
+
+    Returns the response: server-sent events if stream is set, otherwise {"response": reply}, or
+    {"error": "Chat not found"} for another user's chat. Other errors propagate to the route.
+    """
+    async with app.state.pool.acquire() as conn:
+        # Load the chat and its recent history (it is created together with the first messages if not)
+        chat, chat_history = await load_chat_state(conn, chat_id, user_id)
+        if chat and chat["user_id"] != user_id:
+            logger.warning(f"Chat {chat_id} belongs to another user")
+            return {"error": "Chat not found"}
+        if not chat:
+            logger.info(f"Chat not found, creating new chat with chat_id={chat_id}")
+        logger.debug("Chat history: %s", chat_history)
+
+    # Opt-in streaming ("stream": true): the reply is sent as server-sent events while it is generated
+    if stream:
+        return _reply_stream_response(chat_id, user_id, chat_history, message, new_chat=not chat)
+
+    # Generate the reply (retrying only the Gemini call on key-related errors). A new chat gets its
+    # title generated concurrently; both turns are stored after the response has been sent.
+    async def answer():
+        try:
+            if chat:
+                new_title = None
+                bot_reply = await _generate_with_key_rotation(chat_history, message, user_id=user_id)
+            else:
+                new_title, bot_reply = await asyncio.gather(
+                    generate_title(message),
+                    _generate_with_key_rotation(chat_history, message, user_id=user_id)
+                )
+        except google_exceptions.ClientError:
+            return {"response": "An error occurred while processing your request."}
+        if bot_reply is None:
+            return {"response": KEYS_EXHAUSTED_REPLY}
+        background.add_task(_persist_turns, chat_id, user_id, message, bot_reply, new_chat_title=new_title)
+        if new_title is not None:
+            logger.info(f"New chat title: {new_title}")
+        return {"response": bot_reply}
+
+    return await _answer_turn_once((chat_id, user_id, message), answer)
+
 # --- New API Route: /send_message (Added to Match Frontend Expectations) ---
 @app.post("/send_message")
-async def send_message(request: Request):
-    data = await request.json()
+async def send_message(request: Request, background: BackgroundTasks):
+    data = orjson.loads(await request.body())
     user_id = data.get("user_id", "unknown_user")
     chat_id = data.get("chat_id")
     message = data.get("message")
 
-    print(f"Received send_message request: user_id={user_id}, chat_id={chat_id}, message={message}")
+    logger.info(f"Received send_message request: user_id={user_id}, chat_id={chat_id}, message={message}")
 
     if not chat_id or not message:
-        print("Missing chat_id or message")
+        logger.warning("Missing chat_id or message")
         return {"error": "Missing chat_id or message"}
 
     try:
-        model = genai.GenerativeModel(
-            "gemini-2.5-pro",
-            generation_config={
-                "temperature": 0.7,
-                "top_p": 0.9,
-                "top_k": 40,
-                "max_output_tokens": 8192,
-            }
-        )
-
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            # Check if the chat exists, if not create it
-            cursor.execute(
-                "SELECT title FROM chats WHERE chat_id = %s AND user_id = %s",
-                (chat_id, user_id)
-            )
-            chat = cursor.fetchone()
-            if not chat:
-                print(f"Chat not found, creating new chat with chat_id={chat_id}")
-                cursor.execute(
-                    "INSERT INTO chats (chat_id, user_id, title) VALUES (%s, %s, %s)",
-                    (chat_id, user_id, "New Chat")
-                )
-
-            # Insert user message and get its timestamp
-            cursor.execute(
-                "INSERT INTO messages (chat_id, user_id, role, content) VALUES (%s, %s, %s, %s) RETURNING message_id, timestamp",
-                (chat_id, user_id, "user", message)
-            )
-            user_message_id, user_timestamp = cursor.fetchone()
-            print(f"Inserted user message with message_id={user_message_id}, timestamp={user_timestamp}")
-
-            # Fetch chat history for context, excluding the current user message
-            cursor.execute(
-                "SELECT role, content FROM messages WHERE chat_id = %s AND message_id != %s ORDER BY timestamp ASC",
-                (chat_id, user_message_id)
-            )
-            chat_history = cursor.fetchall()
-            print(f"Chat history: {chat_history}")
-
-            # Build prompt
-            history_text = "\n".join([f"{row[0]}: {row[1]}" for row in chat_history])
-            prompt = f"{PERSONALITY_PROMPT}\n\n{history_text}\nUser: {message}\nAI:"
-            print(f"Prompt sent to model: {prompt[:500]}...")  # Truncate for readability
-
-            # Generate response
-            response = model.generate_content(prompt)
-            if response.text and not response.text.isspace():
-                bot_reply = response.text.strip()
-            else:
-                bot_reply = "I'm sorry, I couldn't generate a response. Please try again."
-            bot_reply = bot_reply.replace("Valen:", "").strip()
-            print(f"Bot reply: {bot_reply}")
-
-            # Insert bot response with a timestamp 1 millisecond later than the user message
-            cursor.execute(
-                "INSERT INTO messages (chat_id, user_id, role, content, timestamp) VALUES (%s, %s, %s, %s, %s + INTERVAL '1 millisecond') RETURNING message_id",
-                (chat_id, user_id, "bot", bot_reply, user_timestamp)
-            )
-            bot_message_id = cursor.fetchone()[0]
-            print(f"Inserted bot message with message_id={bot_message_id}")
-
-        conn.commit()
-        conn.close()
-
-        # If new chat, update title
-        if not chat:
-            try:
-                new_title = generate_title(message)
-                conn = get_db_connection()
-                with conn.cursor() as cursor:
-                    cursor.execute(
-                        "UPDATE chats SET title = %s WHERE chat_id = %s AND user_id = %s",
-                        (new_title, chat_id, user_id)
-                    )
-                conn.commit()
-                conn.close()
-                print(f"Updated chat title to: {new_title}")
-            except Exception as e:
-                print(f"Failed to update chat title: {e}")
-
-        return {"response": bot_reply}
-
-    except google_exceptions.ClientError as e:
-        print(f"Gemini API ClientError: {e}")
-        if "invalid API key" in str(e).lower():
-            if len(api_key_queue) > 1:
-                print("Switching to the next API key...")
-                api_key_queue.rotate(-1)
-                genai.configure(api_key=get_next_api_key())
-                return await send_message(request)  # Retry with new key
-            else:
-                return {"response": "Due to unexpected capacity constraints, I am unable to respond to your message. Please try again soon."}
-        elif "quota exceeded" in str(e).lower():
-            if len(api_key_queue) > 1:
-                print("Switching to the next API key (quota exceeded)...")
-                api_key_queue.rotate(-1)
-                genai.configure(api_key=get_next_api_key())
-                return await send_message(request)  # Retry with new key
-            else:
-                return {"response": "Due to unexpected capacity constraints, I am unable to respond to your message. Please try again soon."}
-        else:
-            return {"response": "An error occurred while processing your request."}
+        return await _answer_chat_turn(chat_id, user_id, message, data.get("stream"), background)
 
     except Exception as e:
-        print(f"Error in send_message: {str(e)}")
+        logger.error(f"Error in send_message: {str(e)}")
         return {"error": f"Failed to process message: {str(e)}"}
 
 # --- API Route for Web Requests (Modified with Logging and Chat Creation) ---
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
 @app.post("/chat")
-async def chat(request: Request):
-    data = await request.json()
+async def chat(request: Request, background: BackgroundTasks):
+    data = orjson.loads(await request.body())
     user_id = data.get("user_id", "unknown_user")
     chat_id = data.get("chat_id")
     user_message = data.get("message")
@@ -497,148 +1057,59 @@ async def chat(request: Request):
         return {"error": "No message or chat ID provided"}
 
     try:
-        model = genai.GenerativeModel(
-            "gemini-2.5-pro",
-            generation_config={
-                "temperature": 0.7,
-                "top_p": 0.9,
-                "top_k": 40,
-                "max_output_tokens": 8192,
-            }
-        )
-
-        # Database Operations (LOAD HISTORY OR CREATE CHAT)
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            # Check if chat exists
-            cursor.execute(
-                "SELECT title FROM chats WHERE chat_id = %s AND user_id = %s",
-                (chat_id, user_id)
-            )
-            chat = cursor.fetchone()
-            if not chat:
-                logger.info(f"Chat not found, creating new chat with chat_id={chat_id}")
-                cursor.execute(
-                    "INSERT INTO chats (chat_id, user_id, title) VALUES (%s, %s, %s)",
-                    (chat_id, user_id, "New Chat")
-                )
-
-            # Insert user message
-            cursor.execute(
-                "INSERT INTO messages (chat_id, user_id, role, content) VALUES (%s, %s, %s, %s) RETURNING message_id",
-                (chat_id, user_id, "user", user_message)
-            )
-            user_message_id = cursor.fetchone()[0]
-            logger.info(f"Inserted user message with message_id={user_message_id}")
-
-            # Fetch chat history
-            cursor.execute(
-                "SELECT role, content FROM messages WHERE chat_id = %s ORDER BY timestamp ASC",
-                (chat_id,)
-            )
-            chat_history = [f"{row[0]}: {row[1]}" for row in cursor.fetchall()]
-            logger.info(f"Chat history: {chat_history}")
-
-        # CONTEXT WINDOW LIMIT
-        chat_history = chat_history[-100:]  # Keep only the last 100 entries
-        chat_history.append(f"User: {user_message}")
-        prompt = f"{PERSONALITY_PROMPT}\n\n" + "\n".join(chat_history) + "\nAI:"
-        logger.info(f"Prompt sent to model: {prompt[:500]}...")  # Truncate for readability
-
-        response = model.generate_content(prompt)
-        if response.text and not response.text.isspace():
-            bot_reply = response.text.strip()
-        else:
-            bot_reply = "I'm sorry, I couldn't generate a response. Please try again."
-        bot_reply = bot_reply.replace("Valen:", "").strip()
-        logger.info(f"Bot reply: {bot_reply}")
-
-        # Insert bot reply
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO messages (chat_id, user_id, role, content) VALUES (%s, %s, %s, %s) RETURNING message_id",
-                (chat_id, user_id, "bot", bot_reply)
-            )
-            bot_message_id = cursor.fetchone()[0]
-            logger.info(f"Inserted bot message with message_id={bot_message_id}")
-
-        conn.commit()
-        conn.close()
-
-        # If new chat, update title
-        if not chat:
-            new_title = generate_title(user_message)
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    "UPDATE chats SET title = %s WHERE chat_id = %s AND user_id = %s",
-                    (new_title, chat_id, user_id)
-                )
-            conn.commit()
-            logger.info(f"Updated chat title to: {new_title}")
-
-        return {"response": bot_reply}
-
-    except google_exceptions.ClientError as e:
-        logger.error(f"Gemini API ClientError: {e}")
-        if "invalid API key" in str(e).lower():
-            if len(api_key_queue) > 1:
-                logger.info("Switching to the next API key...")
-                api_key_queue.rotate(-1)
-                genai.configure(api_key=get_next_api_key())
-                return await chat(request)  # Retry with new key
-            else:
-                return {"response": "Due to unexpected capacity constraints, I am unable to respond to your message. Please try again soon."}
-        elif "quota exceeded" in str(e).lower():
-            if len(api_key_queue) > 1:
-                logger.info("Switching to the next API key (quota exceeded)...")
-                api_key_queue.rotate(-1)
-                genai.configure(api_key=get_next_api_key())
-                return await chat(request)  # Retry with new key
-            else:
-                return {"response": "Due to unexpected capacity constraints, I am unable to respond to your message. Please try again soon."}
-        else:
-            return {"response": "An error occurred while processing your request."}
+        return await _answer_chat_turn(chat_id, user_id, user_message, data.get("stream"), background)
 
     except Exception as e:
         logger.error(f"Error generating response: {e}")
         return {"response": "An error occurred while generating a response."}
 
+# Formats the timestamp in Postgres, in the same ISO 8601 UTC form the cursor accepts back
+HISTORY_TIMESTAMP_SQL = """to_char(timestamp AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"') AS timestamp"""
+
 @app.post("/chat_history")
 async def get_chat_history(request: Request):
-    data = await request.json()
+    data = orjson.loads(await request.body())
     user_id = data.get("user_id", "unknown_user")
     chat_id = data.get("chat_id")
+    limit = data.get("limit")  # Optional: only return the newest `limit` messages
+    before_timestamp = data.get("before_timestamp")  # Optional cursor: only messages older than this
 
     if not chat_id:
         return {"error": "Missing chat_id"}
 
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT message_id, role, content, timestamp FROM messages WHERE chat_id = %s ORDER BY timestamp ASC",
-                (chat_id,)
-            )
-            history = []
-            for row in cursor.fetchall():
-                message_id, role, content, timestamp = row  # Unpack all values
-                history.append({
-                    "message_id": message_id,  # Include message_id
-                    "role": role,
-                    "content": content,
-                    "timestamp": timestamp.isoformat()
-                })
-
-        conn.close()
-        return {"history": history}
+        async with app.state.pool.acquire() as conn:
+            if limit is None and before_timestamp is None:
+                rows = await conn.fetch(
+                    f"""
+                    SELECT message_id, role, content, {HISTORY_TIMESTAMP_SQL} FROM messages
+                    WHERE chat_id = $1 ORDER BY messages.timestamp ASC
+                    """,
+                    chat_id
+                )
+            else:
+                # Page backwards from the cursor, then return the page oldest first
+                before = datetime.datetime.fromisoformat(before_timestamp) if before_timestamp else None
+                rows = await conn.fetch(
+                    f"""
+                    SELECT message_id, role, content, {HISTORY_TIMESTAMP_SQL} FROM (
+                        SELECT message_id, role, content, timestamp FROM messages
+                        WHERE chat_id = $1 AND ($2::timestamptz IS NULL OR timestamp < $2)
+                        ORDER BY timestamp DESC LIMIT $3
+                    ) page ORDER BY page.timestamp ASC
+                    """,
+                    chat_id, before, int(limit) if limit is not None else None
+                )
+        # Rows already carry message_id, role, content and the formatted timestamp
+        return {"history": [dict(row) for row in rows]}
 
     except Exception as e:
-        print(f"Error fetching chat history: {e}")
+        logger.error(f"Error fetching chat history: {e}")
         return {"error": "Failed to retrieve chat history", "history": []}
 
 @app.post("/update_title")
 async def update_title(request: Request):
-    data = await request.json()
+    data = orjson.loads(await request.body())
     user_id = data.get("user_id", "unknown_user")  # Get user_id (for future use)
     chat_id = data.get("chat_id")
     new_title = data.get("new_title")
@@ -647,23 +1118,20 @@ async def update_title(request: Request):
         return {"error": "Missing chat_id or new_title"}
 
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "UPDATE chats SET title = %s WHERE chat_id = %s AND user_id = %s",
-                (new_title, chat_id, user_id)
+        async with app.state.pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE chats SET title = $1 WHERE chat_id = $2 AND user_id = $3",
+                new_title, chat_id, user_id
             )
-        conn.commit()
-        conn.close()
         return {"success": True}
 
     except Exception as e:
-        print(f"Error updating title: {e}")
+        logger.error(f"Error updating title: {e}")
         return {"error": "Failed to update title", "success": False}
 
 @app.post("/add_favorite")
 async def add_favorite(request: Request):
-    data = await request.json()
+    data = orjson.loads(await request.body())
     user_id = data.get("user_id", "unknown_user")
     chat_id = data.get("chat_id")
 
@@ -671,22 +1139,19 @@ async def add_favorite(request: Request):
         return {"error": "Missing chat_id"}
 
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO favorites (user_id, chat_id) VALUES (%s, %s) ON CONFLICT (user_id, chat_id) DO NOTHING",
-                (user_id, chat_id)
+        async with app.state.pool.acquire() as conn:
+            await conn.execute(
+                "INSERT INTO favorites (user_id, chat_id) VALUES ($1, $2) ON CONFLICT (user_id, chat_id) DO NOTHING",
+                user_id, chat_id
             )
-        conn.commit()
-        conn.close()
         return {"success": True}
     except Exception as e:
-        print(f"Error adding favorite: {e}")
+        logger.error(f"Error adding favorite: {e}")
         return {"error": "Failed to add favorite", "success": False}
 
 @app.post("/remove_favorite")
 async def remove_favorite(request: Request):
-    data = await request.json()
+    data = orjson.loads(await request.body())
     user_id = data.get("user_id", "unknown_user")
     chat_id = data.get("chat_id")
 
@@ -694,17 +1159,14 @@ async def remove_favorite(request: Request):
         return {"error": "Missing chat_id"}
 
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "DELETE FROM favorites WHERE user_id = %s AND chat_id = %s",
-                (user_id, chat_id)
+        async with app.state.pool.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM favorites WHERE user_id = $1 AND chat_id = $2",
+                user_id, chat_id
             )
-        conn.commit()
-        conn.close()
         return {"success": True}
     except Exception as e:
-        print(f"Error removing favorite: {e}")
+        logger.error(f"Error removing favorite: {e}")
         return {"error": "Failed to remove favorite", "success": False}
 
 @app.get("/favorites")
@@ -712,24 +1174,22 @@ async def get_favorites(request: Request):
     user_id = request.query_params.get("user_id", "unknown_user")
 
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT chat_id FROM favorites WHERE user_id = %s",
-                (user_id,)
+        async with app.state.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT chat_id FROM favorites WHERE user_id = $1",
+                user_id
             )
-            favorites = [row[0] for row in cursor.fetchall()]  # Extract chat_ids
+        favorites = [row[0] for row in rows]  # Extract chat_ids
 
-        conn.close()
         return {"favorites": favorites}
 
     except Exception as e:
-        print(f"Error fetching favorites: {e}")
+        logger.error(f"Error fetching favorites: {e}")
         return {"error": "Failed to retrieve favorites", "favorites": []}
 
 @app.post("/delete_chat")
 async def delete_chat(request: Request):
-    data = await request.json()
+    data = orjson.loads(await request.body())
     user_id = data.get("user_id", "unknown_user")
     chat_id = data.get("chat_id")
 
@@ -737,23 +1197,15 @@ async def delete_chat(request: Request):
         return {"error": "Missing chat_id"}
 
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            # 1. Delete any entries in 'favorites' that refer to this chat
-            cursor.execute("DELETE FROM favorites WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
-
-            # 2. Delete messages associated with the chat
-            cursor.execute("DELETE FROM messages WHERE chat_id = %s", (chat_id,))
+        async with app.state.pool.acquire() as conn:
+            # Only the owner's chat is deleted; its messages and 'favorites' rows go with it via ON DELETE CASCADE
+            await conn.execute("DELETE FROM chats WHERE chat_id = $1 AND user_id = $2", chat_id, user_id)
 
-            # 3. Delete the chat itself
-            cursor.execute("DELETE FROM chats WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
-
-        conn.commit()
-        conn.close()
+        forget_history(chat_id)
         return {"success": True}
 
     except Exception as e:
-        print(f"Error deleting chat: {e}")
+        logger.error(f"Error deleting chat: {e}")
         return {"error": "Failed to delete chat", "success": False}
 
 @app.get("/chats")
@@ -761,23 +1213,21 @@ async def get_chats(request: Request):
     # Extract user_id from query parameters
     user_id = request.query_params.get("user_id", "unknown_user")
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:  # Using DictCursor for cleaner code
-            cursor.execute(
-                "SELECT chat_id, title FROM chats WHERE user_id = %s ORDER BY chat_id DESC",  # Sort newest first
-                (user_id,)
+        async with app.state.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT chat_id, title FROM chats WHERE user_id = $1 ORDER BY created_at DESC, chat_id DESC",  # Sort newest first
+                user_id
             )
-            chats = [{"id": row["chat_id"], "title": row["title"]} for row in cursor.fetchall()]
-        conn.close()
+        chats = [{"id": chat_id, "title": title} for chat_id, title in rows]
         return {"chats": chats}
     except Exception as e:
-        print(f"Error fetching chats: {e}")
+        logger.error(f"Error fetching chats: {e}")
         return {"error": "Failed to retrieve chats", "chats": []}
 
 # --- New API route to edit message ---
 @app.post("/edit_message")
 async def edit_message(request: Request):
-    data = await request.json()
+    data = orjson.loads(await request.body())
     user_id = data.get("user_id")
     chat_id = data.get("chat_id")
     message_id = data.get("message_id")
@@ -787,45 +1237,40 @@ async def edit_message(request: Request):
         return {"error": "Missing user_id, chat_id, message_id, or new_content", "success": False}
 
     try:
-        conn = get_db_connection()
-        with conn.cursor() as cursor:
-            # Fetch the original timestamp
-            cursor.execute(
-                "SELECT timestamp FROM messages WHERE chat_id = %s AND message_id = %s AND user_id = %s AND role = 'user'",
-                (chat_id, message_id, user_id)
-            )
-            result = cursor.fetchone()
-            if not result:
-                print(f"Message not found for chat_id={chat_id}, message_id={message_id}, user_id={user_id}")
-                return {"error": "Message not found or not updated", "success": False}
-
-            original_timestamp = result[0]
-
-            # Update the message content while preserving the timestamp
-            cursor.execute(
-                "UPDATE messages SET content = %s, timestamp = %s WHERE chat_id = %s AND message_id = %s AND user_id = %s AND role = 'user'",
-                (new_content, original_timestamp, chat_id, message_id, user_id)
+        message_id = int(message_id)  # asyncpg doesn't coerce strings to integers
+        async with app.state.pool.acquire() as conn:
+            # Update the message content (the timestamp is left alone, so it keeps its place in the chat)
+            # and mark the chat as edited, which invalidates its history cached in other workers
+            status = await conn.execute(
+                """
+                WITH edited AS (
+                    UPDATE messages SET content = $1
+                    WHERE chat_id = $2 AND message_id = $3 AND user_id = $4 AND role = 'user'
+                    RETURNING chat_id
+                )
+                UPDATE chats SET edited_at = CURRENT_TIMESTAMP WHERE chat_id IN (SELECT chat_id FROM edited)
+                """,
+                new_content, chat_id, message_id, user_id
             )
 
-            rows_updated = cursor.rowcount
-            print(f"Rows updated in edit_message: {rows_updated} for chat_id={chat_id}, message_id={message_id}")
+        rows_updated = int(status.split()[-1])  # Status string is "UPDATE <count>" (0 or 1 edited message)
+        logger.info(f"Rows updated in edit_message: {rows_updated} for chat_id={chat_id}, message_id={message_id}")
 
-            if rows_updated == 0:
-                print(f"No rows updated for chat_id={chat_id}, message_id={message_id}, user_id={user_id}")
-                return {"error": "Message not found or not updated", "success": False}
+        if rows_updated == 0:
+            logger.warning(f"No rows updated for chat_id={chat_id}, message_id={message_id}, user_id={user_id}")
+            return {"error": "Message not found or not updated", "success": False}
 
-        conn.commit()
-        conn.close()
+        forget_history(chat_id)  # The cached history still holds the old content
         return {"success": True}
 
     except Exception as e:
-        print(f"Error updating message: {e}")
+        logger.error(f"Error updating message: {e}")
         return {"error": "Failed to update message", "success": False}
 
 # --- New API route to regenerate response after message edit ---
 @app.post("/regenerate_response")
 async def regenerate_response(request: Request):
-    data = await request.json()
+    data = orjson.loads(await request.body())
     user_id = data.get("user_id", "unknown_user")
     chat_id = data.get("chat_id")
     message_id = data.get("message_id")
@@ -835,99 +1280,78 @@ async def regenerate_response(request: Request):
         return {"error": "Missing chat_id or message_id"}
 
     try:
-        model = genai.GenerativeModel(
-            "gemini-2.5-pro",
-            generation_config={
-                "temperature": 0.7,
-                "top_p": 0.9,
-                "top_k": 40,
-                "max_output_tokens": 8192,
-            }
-        )
-
-        # Get chat history up to the edited message
-        conn = get_db_connection()
-        
-        with conn.cursor() as cursor:
-            # Fetch the timestamp of the edited message (for chat history)
-            cursor.execute(
-                "SELECT timestamp FROM messages WHERE chat_id = %s AND message_id = %s",
-                (chat_id, message_id)
-            )
-            edited_message = cursor.fetchone()
-            if not edited_message:
-                print(f"Edited message not found: message_id={message_id}")
-                return {"error": "Edited message not found"}
-
-            edited_timestamp = edited_message[0]
-
-            # Fetch all messages up to but not including the edited message
-            cursor.execute(
-                "SELECT message_id, role, content FROM messages WHERE chat_id = %s AND message_id < %s ORDER BY timestamp ASC",
-                (chat_id, message_id)
+        message_id = int(message_id)  # asyncpg doesn't coerce strings to integers
+        async with app.state.pool.acquire() as conn:
+            # Fetch the edited message (its timestamp places the history cut and the new reply) together
+            # with the newest CONTEXT_WINDOW messages before it, oldest first, in one statement. Only the
+            # chat's owner may regenerate, since everything after the message is deleted below. No rows
+            # means no such message; a message with nothing before it comes back as one row with a NULL role.
+            rows = await conn.fetch(
+                f"""
+                WITH edited AS (
+                    SELECT m.role, m.content, m.timestamp FROM messages m
+                    JOIN chats c ON c.chat_id = m.chat_id
+                    WHERE m.chat_id = $1 AND m.message_id = $2 AND c.user_id = $3
+                )
+                SELECT edited.role AS edited_role, edited.content AS edited_content,
+                       edited.timestamp AS edited_timestamp, recent.role, recent.content
+                FROM edited LEFT JOIN LATERAL (
+                    SELECT role, content, timestamp FROM messages
+                    WHERE chat_id = $1 AND timestamp < edited.timestamp
+                    ORDER BY timestamp DESC LIMIT {CONTEXT_WINDOW}
+                ) recent ON true
+                ORDER BY recent.timestamp ASC
+                """,
+                chat_id, message_id, user_id
             )
-            messages_up_to_edit = cursor.fetchall()
-            print(f"Messages up to edit (message_id {message_id}): {messages_up_to_edit}")
-            
-            # Build the chat history, replacing the edited message's content
-            chat_history = []
-            for msg_id, role, content in messages_up_to_edit:
-                if str(msg_id) == str(message_id):
-                    chat_history.append(f"User: {edited_content}")
-                else:
-                    chat_history.append(f"{role}: {content}")
-            
             # Ensure the edited message exists and is a user message
-            cursor.execute(
-                "SELECT role FROM messages WHERE chat_id = %s AND message_id = %s",
-                (chat_id, message_id)
-            )
-            result = cursor.fetchone()
-            if not result or result[0] != "user":
-                print(f"Edited message not found or not a user message: message_id={message_id}")
+            if not rows or rows[0]["edited_role"] != "user":
+                logger.warning(f"Edited message not found or not a user message: message_id={message_id}")
                 return {"error": "Edited message not found or not a user message"}
-            
-            # Limit the context window
-            chat_history = chat_history[-100:]
-            print(f"Chat history for prompt: {chat_history}")
-            
-            # Generate new response
-            prompt = f"{PERSONALITY_PROMPT}\n\n" + "\n".join(chat_history) + "\nAI:"
-            response = model.generate_content(prompt)
-            
-            if response.text and not response.text.isspace():
-                new_bot_reply = response.text.strip()
-            else:
-                new_bot_reply = "I'm sorry, I couldn't generate a response. Please try again."
-            
-            # Remove "Valen:" prefix if present
-            new_bot_reply = new_bot_reply.replace("Valen:", "").strip()
-            
-            # Delete all bot messages after the edited message
-            cursor.execute(
-                "DELETE FROM messages WHERE chat_id = %s AND role = 'bot' AND message_id > %s",
-                (chat_id, message_id)
-            )
-            print(f"Deleted old bot messages after message_id {message_id}")
-            
-            # Insert a new bot message with a timestamp 1 millisecond later than the edited message
-            cursor.execute(
-                "INSERT INTO messages (chat_id, user_id, role, content, timestamp) VALUES (%s, %s, %s, %s, %s + INTERVAL '1 millisecond') RETURNING message_id",
-                (chat_id, user_id, "bot", new_bot_reply, edited_timestamp)
+            edited_timestamp = rows[0]["edited_timestamp"]
+            chat_history = [(row["role"], row["content"]) for row in rows if row["role"] is not None]
+        logger.debug("Chat history for prompt: %s", chat_history)
+
+        # Generate new response to the edited message (no connection is held while Gemini is generating)
+        # Bypass the reply cache: regenerating is an explicit request for a fresh answer
+        new_bot_reply = await _generate_with_key_rotation(
+            chat_history, edited_content or rows[0]["edited_content"], use_cache=False
+        )
+        if new_bot_reply is None:
+            return {"error": KEYS_EXHAUSTED_REPLY, "success": False}
+
+        async with app.state.pool.acquire() as conn:
+            # The conversation continues from the edited message: delete everything after it (later
+            # replies and the follow-ups that answered them) and insert the new bot message with a
+            # timestamp 1 millisecond later than the edited message, in one atomic statement
+            bot_message_id = await conn.fetchval(
+                """
+                WITH deleted AS (
+                    DELETE FROM messages WHERE chat_id = $1 AND timestamp > $4
+                )
+                INSERT INTO messages (chat_id, user_id, role, content, timestamp)
+                VALUES ($1, $2, 'bot', $3, $4::timestamptz + INTERVAL '1 millisecond')
+                RETURNING message_id
+                """,
+                chat_id, user_id, new_bot_reply, edited_timestamp
             )
-            bot_message_id = cursor.fetchone()[0]
-            print(f"Inserted new bot message with message_id {bot_message_id}")
-        
-        conn.commit()
-        conn.close()
-        
+            logger.info(f"Replaced messages after message_id {message_id} with message_id {bot_message_id}")
+
+        forget_history(chat_id)
         return {"success": True, "response": new_bot_reply}
 
     except Exception as e:
-        print(f"Error regenerating response: {e}")
+        logger.error(f"Error regenerating response: {e}")
         return {"error": f"Failed to regenerate response: {str(e)}", "success": False}
 
 # --- Run the API ---
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "valenai:app",  # Import string so each worker loads its own app (and DB state)
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    )